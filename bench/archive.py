@@ -0,0 +1,171 @@
+"""Deterministic generator of synthetic archives for benchmarks.
+
+Each host has a local source tree per archive tree, which is uploaded once
+per snapshot the way rsyba-client does it: into a new snapshot directory
+with --link-dest pointing at latest. Between snapshots, a fraction of the
+files (the churn) is modified, removed or added. A fraction of the files
+(the duplicate ratio) has the same content on all hosts, which is what
+dedup-snapshots finds.
+
+With use_rsync=False, the upload is emulated by hard linking files whose
+size and mtime are unchanged since the previous snapshot, for machines
+without rsync.
+
+Usage: python3 -m bench.archive [options] <path>
+"""
+
+import argparse
+import datetime
+import os
+import random
+import shutil
+
+from rsyba import rsync
+from rsyba import server
+
+# Snapshot timestamps and file mtimes count from here, so runs are identical.
+EPOCH = datetime.datetime(2024, 1, 1)
+FILES_PER_DIR = 100
+
+class SourceTree(object):
+    """The local files of one host in one tree, and how they change."""
+
+    def __init__(self, path, tree, host, files, dup_ratio, file_size, seed):
+        self.path = path
+        self.host = host
+        self.dup_ratio = dup_ratio
+        self.file_size = file_size
+        self.rnd = random.Random('%s/%s/%s' % (seed, tree, host))
+        self.seed = seed
+        self.tree = tree
+        self.versions = {} # {file number: version}
+        self.next_file = 0
+        for _ in range(files):
+            self.add()
+
+    def relpath(self, i):
+        return os.path.join('d%04d' % (i // FILES_PER_DIR), 'f%06d' % (i,))
+
+    def content(self, i, version):
+        # Duplicates depend only on the file number and version, so they are
+        # equal on all hosts. Everything else also depends on the host.
+        shared = random.Random('%s/%s/%d' % (self.seed, self.tree, i)).random() < self.dup_ratio
+        rnd = random.Random('%s/%s/%d/%d/%s' % (self.seed, self.tree, i, version, '' if shared else self.host))
+        return rnd.randbytes(rnd.randint(0, 2 * self.file_size))
+
+    def write(self, i, snapshot):
+        path = os.path.join(self.path, self.relpath(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(self.content(i, self.versions[i]))
+        mtime = int((EPOCH + datetime.timedelta(days=snapshot) - datetime.datetime(1970, 1, 1)).total_seconds())
+        os.utime(path, ns=(mtime * 10**9, mtime * 10**9))
+
+    def add(self, snapshot=0):
+        self.versions[self.next_file] = 0
+        self.write(self.next_file, snapshot)
+        self.next_file += 1
+
+    def churn(self, ratio, snapshot):
+        """Modify, remove and add files, 8:1:1, for ratio of the files in total."""
+        n = int(len(self.versions) * ratio)
+        for i in self.rnd.sample(sorted(self.versions), min(n, len(self.versions))):
+            r = self.rnd.random()
+            if r < 0.8:
+                self.versions[i] += 1
+                self.write(i, snapshot)
+            elif r < 0.9:
+                del self.versions[i]
+                os.unlink(os.path.join(self.path, self.relpath(i)))
+            else:
+                self.add(snapshot)
+
+def snapshot_ts(snapshot, host_index):
+    return (EPOCH + datetime.timedelta(days=snapshot, seconds=host_index)).strftime('%Y-%m-%dT%H-%M-%S.%f')
+
+def upload(arch, src, tree, host, ts, use_rsync=True):
+    """Upload src as a new snapshot, the way rsyba-client does."""
+    hpath = arch.get_host_path(tree, host)
+    latest = arch.get_latest_up(tree, host) if os.path.lexists(os.path.join(hpath, 'latest')) else None
+    dest = os.path.join(hpath, ts)
+    if use_rsync:
+        rsync.run(dest + os.sep, src + os.sep, archive=True, link_dest=latest and latest + os.sep)
+    else:
+        for dpath, dnames, fnames in os.walk(src):
+            rel = os.path.relpath(dpath, src)
+            os.makedirs(os.path.join(dest, rel), exist_ok=True)
+            for fname in fnames:
+                spath = os.path.join(dpath, fname)
+                lpath = latest and os.path.join(latest, rel, fname)
+                st = os.stat(spath)
+                try:
+                    lst = lpath and os.stat(lpath)
+                except FileNotFoundError:
+                    lst = None
+                if lst is not None and (lst.st_size, lst.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+                    os.link(lpath, os.path.join(dest, rel, fname))
+                else:
+                    shutil.copy2(spath, os.path.join(dest, rel, fname))
+
+    os.symlink(ts, dest + '.complete')
+    os.symlink(ts, os.path.join(hpath, 'latest.tmp'))
+    os.rename(os.path.join(hpath, 'latest.tmp'), os.path.join(hpath, 'latest'))
+
+def generate(path, hosts=2, trees=1, snapshots=4, files=1000, dup_ratio=0.5, churn=0.05, file_size=4096, seed=0, use_rsync=True):
+    """Create an archive in path, which must not exist.
+
+       Local source trees are kept in path/src.
+
+       @return the FileSystemArchive.
+    """
+    os.makedirs(path)
+    arch = server.FileSystemArchive(os.path.join(path, 'archive'))
+    os.makedirs(arch.path)
+    arch.init()
+    tree_names = ['t%d' % (i,) for i in range(trees)]
+    host_names = ['host%d' % (i,) for i in range(hosts)]
+    arch.add_trees(tree_names)
+
+    for tree in tree_names:
+        for hi, host in enumerate(host_names):
+            # Like add_hosts, but without its initial empty snapshot, which
+            # would be named after the current time.
+            os.makedirs(os.path.join(arch.get_host_path(tree, host), 'tmp'))
+            os.makedirs(arch.get_down_path(tree, host))
+            src = SourceTree(os.path.join(path, 'src', tree, host), tree, host, files, dup_ratio, file_size, seed)
+            for snapshot in range(snapshots):
+                if snapshot:
+                    src.churn(churn, snapshot)
+                upload(arch, src.path, tree, host, snapshot_ts(snapshot, hi), use_rsync=use_rsync)
+
+            dhpath = arch.get_down_path(tree, host)
+            os.symlink(os.path.relpath(arch.get_latest_up(tree, host), dhpath), os.path.join(dhpath, 'latest'))
+
+    return arch
+
+def add_arguments(argp):
+    argp.add_argument('--hosts', metavar='N', type=int, default=2, help='number of hosts [default %(default)s]')
+    argp.add_argument('--trees', metavar='N', type=int, default=1, help='number of trees [default %(default)s]')
+    argp.add_argument('--snapshots', metavar='N', type=int, default=4, help='number of snapshots per host and tree [default %(default)s]')
+    argp.add_argument('--files', metavar='N', type=int, default=1000, help='number of files per snapshot [default %(default)s]')
+    argp.add_argument('--dup-ratio', metavar='R', type=float, default=0.5, help='fraction of files equal on all hosts [default %(default)s]')
+    argp.add_argument('--churn', metavar='R', type=float, default=0.05, help='fraction of files changed between snapshots [default %(default)s]')
+    argp.add_argument('--file-size', metavar='BYTES', type=int, default=4096, help='mean file size [default %(default)s]')
+    argp.add_argument('--seed', metavar='N', type=int, default=0, help='random seed [default %(default)s]')
+    argp.add_argument('--no-rsync', dest='use_rsync', action='store_false', default=True, help='emulate rsync --link-dest with hard links')
+
+def generate_args(path, args):
+    return generate(path, hosts=args.hosts, trees=args.trees, snapshots=args.snapshots, files=args.files,
+                    dup_ratio=args.dup_ratio, churn=args.churn, file_size=args.file_size, seed=args.seed,
+                    use_rsync=args.use_rsync)
+
+def main():
+    argp = argparse.ArgumentParser()
+    add_arguments(argp)
+    argp.add_argument('path', help='directory to create')
+    args = argp.parse_args()
+
+    generate_args(args.path, args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Micro-benchmark of rsync.run_iter() change parsing.
+
+A fake rsync replays canned --out-format lines, so this measures only the
+pipe reading and FileChange parsing done in Python.
+
+Usage: python3 -m bench.rsync_parse [--lines N] [--repeat N]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from rsyba import rsync
+
+FAKE_RSYNC = '''#!/bin/sh
+exec cat "$RSYBA_BENCH_INPUT"
+'''
+
+# Fields in the order run_iter() puts them in --out-format.
+FIELDS = ['transferred', 'posix_perms', 'updates', 'size', 'mtime', 'op', 'time', 'uid', 'gid', 'filename']
+
+def write_lines(f, n, gen_changes):
+    """Write n change lines, as run_iter(gen_changes=gen_changes) asks rsync for."""
+    fields = [field for field in FIELDS if gen_changes is True or getattr(gen_changes, field)]
+    for i in range(n):
+        values = {
+            'transferred': i % 65536,
+            'posix_perms': 'rw-r--r--',
+            'updates': '>f+++++++++',
+            'size': i * 7,
+            'mtime': '2024/01/02-03:04:%02d' % (i % 60,),
+            'op': 'send',
+            'time': '2024/05/06-07:08:09',
+            'uid': 1000,
+            'gid': 1000,
+            'filename': 'home/user/dir%d/file%d.txt' % (i // 100, i),
+        }
+        print(rsync.CHANGE_PREFIX, *[values[field] for field in fields], sep='\t', file=f)
+        if i % 1000 == 0:
+            # Noise rsync prints that is not a change line.
+            print('sending incremental file list', file=f)
+
+def run(path, gen_changes):
+    n = 0
+    start = time.perf_counter()
+    for ch in rsync.run_iter('dest', 'src', rsync_bin=path, gen_changes=gen_changes):
+        n += 1
+    return n, time.perf_counter() - start
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--lines', metavar='N', type=int, default=200000, help='number of change lines [default %(default)s]')
+    argp.add_argument('--repeat', metavar='N', type=int, default=3, help='number of runs to take the best of [default %(default)s]')
+    args = argp.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='rsyba_bench') as tmpd:
+        path = os.path.join(tmpd, 'rsync')
+        with open(path, 'wt') as f:
+            f.write(FAKE_RSYNC)
+        os.chmod(path, 0o755)
+
+        # All fields, and the subset rsyba-client asks for.
+        for name, gen_changes in [
+                ('all fields', True),
+                ('client fields', rsync.FileChange(filename=True, size=True, updates=True, mtime=True))]:
+            os.environ['RSYBA_BENCH_INPUT'] = os.path.join(tmpd, 'input')
+            with open(os.environ['RSYBA_BENCH_INPUT'], 'wt') as f:
+                write_lines(f, args.lines, gen_changes)
+
+            n, t = min((run(path, gen_changes) for _ in range(args.repeat)), key=lambda x: x[1])
+            print('%-14s %8d lines %7.3f s %10.0f lines/s' % (name, n, t, n / t))
+
+if __name__ == '__main__':
+    main()
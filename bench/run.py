@@ -0,0 +1,242 @@
+"""Benchmark scenarios for server and client hot paths.
+
+Generates an archive with bench.archive (or uses --archive), then runs
+each scenario in a fresh Python process, so peak RSS and I/O counters
+belong to that scenario alone. Scenarios that modify the archive run on a
+copy. Results are written as JSON, to compare runs across commits.
+
+Per run, this records wall and CPU time, peak RSS (including setup, which
+is small next to the measured work), the /proc/self/io counters (bytes
+and read/write syscalls) and files processed per second.
+
+Usage: python3 -m bench.run [options] [--scenario NAME]...
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import archive
+from bench import rsync_parse
+from rsyba import rsync
+from rsyba import server
+
+# {name: (function, whether it modifies the archive)}
+SCENARIOS = collections.OrderedDict()
+
+def scenario(name, modifies=False):
+    """Register a scenario.
+
+       The function does any setup, and returns a function doing the
+       measured work, which returns the number of files processed.
+    """
+    def deco(f):
+        SCENARIOS[name] = (f, modifies)
+        return f
+    return deco
+
+def all_snapshots(arch):
+    return [ss for tree in arch.get_trees() for host in arch.get_hosts(tree) for ss in arch.get_snapshots(tree, host)]
+
+@scenario('walk')
+def walk(arch, args):
+    def run():
+        return sum(1 for ss in all_snapshots(arch) for _ in arch._walk_files(ss))
+    return run
+
+@scenario('build_manifests', modifies=True)
+def build_manifests(arch, args):
+    def run():
+        for ss in all_snapshots(arch):
+            arch.build_manifest(ss)
+        return sum(1 for ss in all_snapshots(arch) for _ in arch._list_files(ss))
+    return run
+
+@scenario('read_manifests', modifies=True)
+def read_manifests(arch, args):
+    for ss in all_snapshots(arch):
+        arch.build_manifest(ss)
+
+    def run():
+        return sum(1 for ss in all_snapshots(arch) for _ in arch._list_files(ss))
+    return run
+
+@scenario('merge')
+def merge(arch, args):
+    def run():
+        n = 0
+        for tree in arch.get_trees():
+            paths = [ss for host in arch.get_hosts(tree) for ss in arch.get_snapshots(tree, host)]
+            for items in arch._merge_file_iters(((arch._walk_files(p), p) for p in paths), key=lambda x: x.name):
+                n += len(items)
+        return n
+    return run
+
+def dedup_scenario(by_content):
+    def setup(arch, args):
+        def run():
+            n = 0
+            for tree in arch.get_trees():
+                stats = arch.dedup_snapshots(tree, arch.get_hosts(tree), jobs=args.jobs, by_content=by_content)
+                n += stats['linked_skipped'] + stats['known_skipped'] + stats['candidates']
+            return n
+        return run
+    return setup
+
+scenario('dedup', modifies=True)(dedup_scenario(False))
+scenario('dedup_by_content', modifies=True)(dedup_scenario(True))
+
+@scenario('diff')
+def diff(arch, args):
+    def run():
+        n = 0
+        for tree in arch.get_trees():
+            for host in arch.get_hosts(tree):
+                sss = arch.get_snapshots(tree, host)
+                for old, new in zip(sss, sss[1:]):
+                    n += sum(1 for _ in arch.diff_snapshots(old, new))
+        return n
+    return run
+
+@scenario('filter_garbage')
+def filter_garbage(arch, args):
+    # Only names matter, so use an hourly history of synthetic ones.
+    start = datetime.datetime(2020, 1, 1)
+    snapshots = [os.path.join('/', (start + datetime.timedelta(hours=i)).strftime('%Y-%m-%dT%H-%M-%S.%f'))
+                 for i in range(args.garbage_snapshots)]
+
+    def run():
+        list(arch.filter_garbage_snapshots(snapshots))
+        return len(snapshots)
+    return run
+
+@scenario('remove', modifies=True)
+def remove(arch, args):
+    def run():
+        snapshots = [ss for tree in arch.get_trees() for host in arch.get_hosts(tree) for ss in arch.get_snapshots(tree, host)[:-1]]
+        return arch.remove_snapshots(snapshots, jobs=args.jobs)['files']
+    return run
+
+@scenario('rsync_parse')
+def rsync_parse_scenario(arch, args):
+    tmpd = tempfile.mkdtemp(prefix='rsyba_bench', dir=os.path.join(arch.path, 'tmp'))
+    path = os.path.join(tmpd, 'rsync')
+    with open(path, 'wt') as f:
+        f.write(rsync_parse.FAKE_RSYNC)
+    os.chmod(path, 0o755)
+    gen_changes = rsync.FileChange(filename=True, size=True, updates=True, mtime=True, transferred=True)
+    os.environ['RSYBA_BENCH_INPUT'] = os.path.join(tmpd, 'input')
+    with open(os.environ['RSYBA_BENCH_INPUT'], 'wt') as f:
+        rsync_parse.write_lines(f, args.parse_lines, gen_changes)
+
+    def run():
+        return sum(1 for _ in rsync.run_iter('dest', 'src', rsync_bin=path, gen_changes=gen_changes, transfer_stats=rsync.TransferStats()))
+    return run
+
+def read_proc_io():
+    try:
+        with open('/proc/self/io', 'rt') as f:
+            return {k: int(v) for k, v in (l.split(': ') for l in f)}
+    except FileNotFoundError:
+        return {}
+
+def run_child(args):
+    """Run one scenario in this process, and print its measurements as JSON."""
+    arch = server.FileSystemArchive(args.archive)
+    work = SCENARIOS[args.child][0](arch, args)
+
+    io = read_proc_io()
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    files = work()
+    wall = time.perf_counter() - start
+    ru2 = resource.getrusage(resource.RUSAGE_SELF)
+    io2 = read_proc_io()
+
+    json.dump({
+        'wall': wall,
+        'cpu': (ru2.ru_utime - ru.ru_utime) + (ru2.ru_stime - ru.ru_stime),
+        'peak_rss_kb': ru2.ru_maxrss,
+        'io': {k: io2[k] - io[k] for k in io},
+        'files': files,
+        'files_per_s': files / wall if wall else None,
+    }, sys.stdout)
+
+def run_scenario(name, args, tmpd):
+    path = args.archive
+    if SCENARIOS[name][1]:
+        path = os.path.join(tmpd, 'copy')
+        subprocess.check_call(['rm', '-fr', path])
+        subprocess.check_call(['cp', '-a', args.archive, path])
+
+    cmd = [sys.executable, '-m', 'bench.run', '--child', name, '--archive', path,
+           '--jobs', str(args.jobs), '--garbage-snapshots', str(args.garbage_snapshots), '--parse-lines', str(args.parse_lines)]
+    return json.loads(subprocess.check_output(cmd))
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    argp = argparse.ArgumentParser()
+    archive.add_arguments(argp)
+    argp.add_argument('--archive', metavar='PATH', help='use this archive instead of generating one')
+    argp.add_argument('--child', metavar='NAME', help=argparse.SUPPRESS)
+    argp.add_argument('--garbage-snapshots', metavar='N', type=int, default=20000, help='number of snapshot names for filter_garbage [default %(default)s]')
+    argp.add_argument('-j', '--jobs', metavar='N', type=int, default=1, help='concurrency of dedup and remove [default %(default)s]')
+    argp.add_argument('-o', '--output', metavar='PATH', help='write results to this file instead of stdout')
+    argp.add_argument('--parse-lines', metavar='N', type=int, default=200000, help='number of change lines for rsync_parse [default %(default)s]')
+    argp.add_argument('--repeat', metavar='N', type=int, default=3, help='number of runs per scenario [default %(default)s]')
+    argp.add_argument('--scenario', metavar='NAME', action='append', choices=list(SCENARIOS), help='scenario to run [default all]')
+    args = argp.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='rsyba_bench') as tmpd:
+        params = {k: getattr(args, k) for k in ('hosts', 'trees', 'snapshots', 'files', 'dup_ratio', 'churn', 'file_size', 'seed', 'use_rsync')}
+        if args.archive is None:
+            start = time.perf_counter()
+            args.archive = archive.generate_args(os.path.join(tmpd, 'generated'), args).path
+            print('Generated archive in %.1f s.' % (time.perf_counter() - start,), file=sys.stderr)
+        else:
+            params = {}
+        params.update(jobs=args.jobs, garbage_snapshots=args.garbage_snapshots, parse_lines=args.parse_lines)
+
+        results = collections.OrderedDict()
+        for name in args.scenario or SCENARIOS:
+            runs = [run_scenario(name, args, tmpd) for _ in range(args.repeat)]
+            best = min(runs, key=lambda r: r['wall'])
+            print('%-18s %9.3f s %9d files %12.0f files/s %8d KiB' % (
+                name, best['wall'], best['files'], best['files_per_s'] or 0, best['peak_rss_kb']), file=sys.stderr)
+            results[name] = {'best': best, 'runs': runs}
+
+    out = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'params': params,
+        'scenarios': results,
+    }
+    if args.output:
+        with open(args.output, 'wt') as f:
+            json.dump(out, f, indent=2)
+            print(file=f)
+    else:
+        json.dump(out, sys.stdout, indent=2)
+        print()
+
+if __name__ == '__main__':
+    main()
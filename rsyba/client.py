@@ -1,11 +1,18 @@
 import argparse
+import concurrent.futures
 import datetime
+import gzip
+import hashlib
+import heapq
+import json
 import logging
 import os.path
+import random
 import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 from rsyba import rsync
@@ -18,109 +25,537 @@ def remote_path(archive):
 
     return archive
 
+class Progress(object):
+    """Merges the progress of concurrent uploads into one status line."""
+
+    def __init__(self, start, tty):
+        self.start = start
+        self.tty = tty
+        self.lock = threading.Lock()
+        self.nfiles = 0
+        self.active = 0
+        self.next_progress = time.time()
+
+    def begin(self):
+        with self.lock:
+            if self.tty and not self.active:
+                print('Listing files...')
+            self.active += 1
+
+    def update(self, path, tree, ch):
+        with self.lock:
+            self.nfiles += 1
+            t = time.time()
+            if t < self.next_progress:
+                return
+            while self.next_progress <= t:
+                self.next_progress += 1
+
+            if not self.tty:
+                log.debug('%s', ch)
+                return
+
+            cols = int(os.environ.get('COLUMNS', '100'))
+            filename = ch.filename
+            if filename.startswith(path[1:] + os.sep):
+                filename = filename.replace(path[1:], '<%s>' % (tree,))
+            elif self.active > 1:
+                filename = '<%s>/%s' % (tree, filename)
+
+            print('\033[1A[%d %s] %s %.*s\033[K' % (self.nfiles, datetime.timedelta(seconds=t - self.start), ch.updates, cols - 40, filename))
+            sys.stdout.flush()
+
+    def end(self):
+        with self.lock:
+            self.active -= 1
+            if self.tty and not self.active:
+                print('\033[1A[%d %s] Done.\033[K' % (self.nfiles, datetime.timedelta(seconds=time.time() - self.start)))
+
+class BandwidthBudget(object):
+    """Splits a total bandwidth limit between concurrent transfers.
+
+       A transfer gets an equal share of the unallocated bandwidth among
+       itself and the transfers that can still start alongside it. Finished
+       transfers hand their share back for the ones starting later.
+    """
+
+    def __init__(self, total, ntransfers, nslots):
+        self.lock = threading.Lock()
+        self.free = total
+        self.pending = ntransfers
+        self.free_slots = nslots
+
+    def acquire(self):
+        with self.lock:
+            n = max(1, min(self.free_slots, self.pending))
+            self.pending -= 1
+            self.free_slots -= 1
+            if self.free is None:
+                return None
+
+            share = max(1, self.free // n)
+            self.free -= share
+            return share
+
+    def skip(self):
+        """Give up the share of a transfer that won't start."""
+        with self.lock:
+            self.pending -= 1
+
+    def release(self, share):
+        with self.lock:
+            self.free_slots += 1
+            if self.free is not None:
+                self.free += share
+
+def parse_local(pt):
+    pt = pt.split('=', 1)
+    if len(pt) == 1:
+        (path, tree) = pt[0], os.path.basename(pt[0])
+    else:
+        (path, tree) = pt
+
+    return os.path.abspath(path), tree
+
+# Where rsync keeps partially transferred files between attempts, relative
+# to each destination directory.
+PARTIAL_DIR = '.rsyba-partial'
+
+# Cost of a file in bytes, when balancing shards. This accounts for the
+# per-file round trips that dominate trees of small files.
+SHARD_FILE_COST = 16384
+
+def scan_usage(path):
+    """Return (number of files, total size) below path."""
+    nfiles, size = 0, 0
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    n, s = scan_usage(e.path)
+                    nfiles += n
+                    size += s
+                else:
+                    nfiles += 1
+                    size += e.stat(follow_symlinks=False).st_size
+    except (FileNotFoundError, PermissionError):
+        pass
+
+    return nfiles, size
+
+def plan_shards(path, n):
+    """Split the top-level entries of path into at most n balanced shards.
+
+       @return a list of lists of entry names.
+    """
+    costs = []
+    with os.scandir(path) as it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                nfiles, size = scan_usage(e.path)
+            else:
+                nfiles, size = 1, e.stat(follow_symlinks=False).st_size
+            costs.append((nfiles * SHARD_FILE_COST + size, e.name))
+
+    # Largest first, each into the currently cheapest shard.
+    shards = [(0, i, []) for i in range(max(1, min(n, len(costs))))]
+    for cost, name in sorted(costs, reverse=True):
+        total, i, names = heapq.heappop(shards)
+        names.append(name)
+        heapq.heappush(shards, (total + cost, i, names))
+
+    return [names for _, _, names in sorted(shards, key=lambda x: x[1])]
+
+def escape_pattern(name):
+    return ''.join('\\' + c if c in '*?[\\' else c for c in name)
+
+def shard_filters(shards, filters):
+    """Return the filter rules for each shard.
+
+       Names of other shards are excluded before the user's rules, so those
+       still apply to the shard's own names. Top-level names created after
+       planning go to the first shard.
+    """
+    ret = []
+    for i, names in enumerate(shards):
+        rules = ['- /' + escape_pattern(name) for j, other in enumerate(shards) if j != i for name in other]
+        rules += filters
+        if i:
+            rules += ['+ /' + escape_pattern(name) for name in names] + ['- /*']
+        ret.append(rules)
+
+    return ret
+
+def default_state_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'rsyba')
+
+def scan_state(path, prefix=''):
+    """Yield (relpath, mode, size, mtime_ns, inode) of everything below path.
+
+       Entries that can't be scanned are yielded with None fields, and a
+       directory that can't be listed by its relpath with a trailing slash.
+    """
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except (FileNotFoundError, PermissionError):
+        yield (prefix, None, None, None, None)
+        return
+
+    for e in entries:
+        name = prefix + e.name
+        try:
+            st = e.stat(follow_symlinks=False)
+        except (FileNotFoundError, PermissionError):
+            yield (name, None, None, None, None)
+            continue
+        yield (name, st.st_mode, st.st_size, st.st_mtime_ns, st.st_ino)
+        if e.is_dir(follow_symlinks=False):
+            yield from scan_state(e.path, name + '/')
+
+class Journal(object):
+    """Remembers the state of a local tree as of its last successful upload.
+
+       The state file is a gzip'd list of NUL terminated records, keyed by
+       everything that affects what rsync would upload. A scan matching it
+       means the upload can be skipped entirely.
+    """
+
+    def __init__(self, state_dir, args, tree):
+        key = '\0'.join([args.archive, args.hostname, tree, str(args.max_file_size)] + args.filter)
+        self.path = os.path.join(state_dir, hashlib.sha256(key.encode('utf-8', 'surrogateescape')).hexdigest()[:32] + '.gz')
+        self.state = None
+
+    def load(self):
+        try:
+            with gzip.open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        ret = {}
+        for rec in data.split(b'\0')[:-1]:
+            mode, size, mtime_ns, ino, name = rec.split(b'\t', 4)
+            ret[os.fsdecode(name)] = (int(mode), int(size), int(mtime_ns), int(ino))
+
+        return ret
+
+    def scan(self, path):
+        """Scan path, returning the number of entries changed since the saved state.
+
+           Entries that couldn't be scanned always count as changed.
+
+           @return None if there is no saved state.
+        """
+        self.state = {e[0]: e[1:] for e in scan_state(path)}
+        old = self.load()
+        if old is None:
+            return None
+
+        return sum(1 for name, v in self.state.items() if old.get(name) != v) + sum(1 for name in old if name not in self.state)
+
+    def save(self):
+        """Save the state from the last scan()."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with gzip.open(tmp, 'wb', compresslevel=1) as f:
+            for name, (mode, size, mtime_ns, ino) in sorted(self.state.items()):
+                if mode is None:
+                    # Left out, so it is changed in the next scan too.
+                    continue
+                f.write(b'%d\t%d\t%d\t%d\t%s\0' % (mode, size, mtime_ns, ino, os.fsencode(name)))
+        os.replace(tmp, self.path)
+
+def upload(args, ts, start, path, tree, progress, budget):
+    host_base = '/'.join([args.archive.rstrip('/'), 'upload', tree, args.hostname])
+
+    try:
+        if args.shards > 1:
+            filters = shard_filters(plan_shards(path, args.shards), args.filter)
+            log.debug('Split tree %r into %d shards.', tree, len(filters))
+        else:
+            filters = [args.filter]
+
+        journal = None
+        nchanged = None
+        if args.skip_unchanged:
+            journal = Journal(args.state_dir, args, tree)
+            nchanged = journal.scan(path)
+    except:
+        # Otherwise later transfers would leave bandwidth for this one.
+        budget.skip()
+        raise
+
+    if nchanged == 0:
+        log.info('Tree %r is unchanged since the last upload. Skipping.', tree)
+        budget.skip()
+        return None
+    if nchanged is not None:
+        log.debug('Found %d changed entries in tree %r.', nchanged, tree)
+
+    log.debug('Starting upload for tree %r...', tree)
+    bwlimit = budget.acquire()
+    try:
+        if len(filters) > 1:
+            # rsync fails if another process creates its destination
+            # directory while it does, so shards can't race for it.
+            with tempfile.TemporaryDirectory(prefix='rsyba_tmp') as dpath:
+                rsync.run(
+                    '/'.join([host_base, ts, '']),
+                    dpath + os.sep,
+                    dry_run=args.dry_run,
+                    link_dest=remote_path('/'.join([host_base, 'latest', ''])),
+                    temp_dir=remote_path('/'.join([host_base, 'tmp', ''])),
+                    timeout=args.timeout)
+
+        # All shards write to the same snapshot, which is only marked
+        # complete once every one of them succeeded.
+        shard_stats = [rsync.TransferStats() for _ in filters]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(filters)) as pool:
+            futures = [
+                pool.submit(transfer, args, start, '/'.join([host_base, ts, '']), path, tree, progress, stats,
+                            bwlimit=bwlimit and max(1, bwlimit // len(filters)),
+                            fake_super=True,
+                            filter=rules,
+                            ignore_existing=True,
+                            link_dest=remote_path('/'.join([host_base, 'latest', ''])),
+                            prune_empty_dirs=True,
+                            temp_dir=remote_path('/'.join([host_base, 'tmp', ''])))
+                for rules, stats in zip(filters, shard_stats)]
+        nfiles = sum(future.result() for future in futures)
+    finally:
+        budget.release(bwlimit)
+
+    stats = shard_stats[0]
+    for other in shard_stats[1:]:
+        stats.merge(other)
+
+    log.info('Finalizing upload of tree %r after %d files...', tree, nfiles)
+    with tempfile.TemporaryDirectory(prefix='rsyba_tmp') as dpath:
+        # TODO: latest-up is annoyingly concurrency unsafe. Add lock or don't overwrite a later one.
+        os.symlink(ts, os.path.join(dpath, 'latest'))
+        os.symlink(ts, os.path.join(dpath, ts + '.complete'))
+        rsync.run(
+            '/'.join([host_base, '']),
+            os.path.join(dpath, 'latest'),
+            os.path.join(dpath, ts + '.complete'),
+            dry_run=args.dry_run,
+            links=True,
+            safe_links=True,
+            temp_dir=remote_path('/'.join([host_base, 'tmp', ''])),
+            timeout=60)
+
+    if journal and not args.dry_run:
+        journal.save()
+
+    return stats
+
+def download(args, start, path, tree, progress, budget):
+    """Pull the merged download snapshot of this host into the local tree.
+
+       The local tree is the basis of the transfer, so files this host
+       uploaded itself have the same size and mtime and are skipped, and
+       only changes of other hosts are sent. Newer local files are kept.
+       Updated files are staged in the partial directory and renamed into
+       place at the end, so the tree never holds half-written files.
+    """
+    src = '/'.join([args.archive.rstrip('/'), 'download', tree, args.hostname, 'latest', ''])
+    opts = {}
+    if ':' in args.archive:
+        # Uploads store ownership and modes as extended attributes.
+        opts['remote_option'] = '--fake-super'
+
+    log.debug('Starting download for tree %r...', tree)
+    bwlimit = budget.acquire()
+    try:
+        stats = rsync.TransferStats()
+        nfiles = transfer(args, start, path + os.sep, path, tree, progress, stats,
+                          src=src,
+                          bwlimit=bwlimit,
+                          delay_updates=True,
+                          filter=args.filter,
+                          fuzzy=True,
+                          update=True,
+                          **opts)
+    finally:
+        budget.release(bwlimit)
+
+    log.info('Downloaded tree %r with %d files.', tree, nfiles)
+    return stats
+
+# Retry delays grow exponentially from the base up to the cap.
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 10 * 60
+
+# Number of retries for rsync.RARELY_RETRYABLE_EXITS.
+RARE_RETRIES = 2
+
+def retry_delay(attempt):
+    """Return the delay before a retry, with jitter to spread out clients."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+def transfer(args, start, dest, path, tree, progress, stats, src=None, **kwargs):
+    """Run rsync for (a shard of) a tree, resuming on transient failures.
+
+       Copies the local path to dest, or src to the local path if given.
+       Retries write into the same destination, so files already copied
+       are skipped and partial files are resumed from the partial
+       directory. Statistics of all attempts are added to stats.
+
+       @param kwargs rsync options on top of the common ones.
+       @return the number of changed files.
+    """
+    nfiles = 0
+    attempt = 0
+    rare_retries = 0
+    while True:
+        nbytes = 0
+        nattempt = 0
+        progress.begin()
+        try:
+            it = rsync.run_iter(
+                dest,
+                src or path + os.sep,
+                archive=True,
+                compress=True,
+                dry_run=args.dry_run,
+                max_size=args.max_file_size,
+                partial_dir=PARTIAL_DIR,
+                safe_links=True,
+                timeout=args.timeout,
+                gen_changes=rsync.FileChange(filename=True, size=True, updates=True, mtime=True, transferred=True),
+                transfer_stats=stats,
+                **kwargs)
+            for ch in it:
+                nattempt += 1
+                nbytes += ch.transferred
+                progress.update(path, tree, ch)
+            return nfiles + nattempt
+        except subprocess.CalledProcessError as ex:
+            returncode = ex.returncode
+            nfiles += nattempt
+            log.info('Attempt %d for tree %r transferred %d bytes in %d files.', attempt + 1, tree, nbytes, nattempt)
+            if returncode in rsync.COMPLETE_EXITS:
+                log.warning('Some files of tree %r vanished during transfer.', tree)
+                return nfiles
+            if returncode in rsync.RARELY_RETRYABLE_EXITS:
+                if rare_retries >= RARE_RETRIES:
+                    raise
+                rare_retries += 1
+            elif returncode not in rsync.RETRYABLE_EXITS:
+                raise
+
+            delay = retry_delay(attempt)
+            if time.time() + delay - start >= args.timeout:
+                raise
+        finally:
+            progress.end()
+
+        attempt += 1
+        log.warning('Transfer of tree %r failed with exit code %d. Resuming %s in %.0f s...', tree, returncode, dest, delay)
+        time.sleep(delay)
+
+def format_prometheus(metrics):
+    def labels(**kwargs):
+        return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in sorted(kwargs.items()))
+
+    lines = []
+    def add(name, text, mtype, samples):
+        lines.append('# HELP rsyba_upload_%s %s' % (name, text))
+        lines.append('# TYPE rsyba_upload_%s %s' % (name, mtype))
+        for lbls, value in samples:
+            lines.append('rsyba_upload_%s{%s} %s' % (name, lbls, value))
+
+    host = metrics['hostname']
+    trees = sorted(metrics['trees'].items())
+    add('status', 'Outcome of the last upload of a tree.', 'gauge',
+        [(labels(host=host, tree=tree, status=status), int(m['status'] == status))
+         for tree, m in trees for status in ('ok', 'skipped', 'failed')])
+    add('timestamp_seconds', 'Start time of the last upload of a tree.', 'gauge',
+        [(labels(host=host, tree=tree), metrics['start']) for tree, m in trees])
+    trees = [(tree, m) for tree, m in trees if m['status'] == 'ok']
+    add('duration_seconds', 'Duration of the transfer.', 'gauge',
+        [(labels(host=host, tree=tree), '%.3f' % m['duration']) for tree, m in trees])
+    add('files', 'Number of changed files.', 'gauge',
+        [(labels(host=host, tree=tree), m['files']) for tree, m in trees])
+    add('bytes', 'Bytes of the transfer, by kind.', 'gauge',
+        [(labels(host=host, tree=tree, kind='transferred'), m['transferred_bytes']) for tree, m in trees] +
+        [(labels(host=host, tree=tree, kind=kind[:-len('_bytes')]), m['totals'][kind])
+         for tree, m in trees for kind in sorted(m['totals']) if kind.endswith('_bytes')])
+    add('updates', 'Number of changed files, by update type.', 'gauge',
+        [(labels(host=host, tree=tree, type=t), n) for tree, m in trees for t, n in sorted(m['update_types'].items())])
+
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(path, metrics):
+    """Atomically write metrics as JSON, or in Prometheus text format if path ends in .prom."""
+    if path.endswith('.prom'):
+        data = format_prometheus(metrics)
+    else:
+        data = json.dumps(metrics, indent=2, sort_keys=True) + '\n'
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
 def main():
     argp = argparse.ArgumentParser(usage='%(prog)s [options] <archive> <local>...')
-    argp.add_argument('--bwlimit', metavar='kbps', type=int, help='set transfer bandwidth limit')
+    argp.add_argument('--bwlimit', metavar='kbps', type=int, help='set total transfer bandwidth limit')
+    argp.add_argument('--download', action='store_true', default=False, help='pull the merged snapshot of this host into the local trees instead of uploading')
     argp.add_argument('-n', '--dry-run', action='store_true', default=False, help='do not do any modifications')
     argp.add_argument('-f', '--filter', metavar='RULE', action='append', default=[], help='add source file filter rule')
     argp.add_argument('--hostname', metavar='FQDN', default=socket.gethostname(), help='override hostname [default %(default)s]')
     argp.add_argument('--max-file-size', metavar='INT[KMG]', help='ignore files larger than this')
+    argp.add_argument('--metrics-file', metavar='PATH', help='write per-tree transfer metrics as JSON, or Prometheus text format if PATH ends in .prom')
+    argp.add_argument('--parallel', metavar='N', type=int, default=1, help='number of trees to upload concurrently [default %(default)s]')
+    argp.add_argument('--shards', metavar='N', type=int, default=1, help='split each tree by top-level entries into this many concurrent transfers [default %(default)s]')
+    argp.add_argument('--skip-unchanged', action='store_true', default=False, help='skip trees that have not changed since their last upload')
+    argp.add_argument('--state-dir', metavar='PATH', default=default_state_dir(), help='where to keep local tree state [default %(default)s]')
     argp.add_argument('--timeout', metavar='INT', type=int, default=12*60*60, help='set transfer time limit in seconds [default %(default)s]')
     argp.add_argument('archive', nargs=1, help='base URL of remote location')
     argp.add_argument('local', metavar='path[=tree]', nargs='+', help='local path with optional archive tree name')
     args = argp.parse_args()
     args.archive = args.archive[0]
+    if args.download and (args.shards > 1 or args.skip_unchanged):
+        argp.error('--download cannot be combined with --shards or --skip-unchanged')
 
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format='%(levelname).1s%(levelname).1s %(asctime)s %(message)s')
     ts = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H-%M-%S.%f')
     start = time.time()
-    nfiles = 0
 
-    if os.isatty(sys.stdout.fileno()):
-        def init_progress():
-            print('Listing files...')
-        def print_progress(path, tree, ch):
-            cols = int(os.environ.get('COLUMNS', '100'))
-            filename = ch.filename
-            if filename.startswith(path[1:] + os.sep):
-                filename = filename.replace(path[1:], '<%s>' % (tree,))
+    sources = [parse_local(pt) for pt in args.local]
+    progress = Progress(start, os.isatty(sys.stdout.fileno()))
+    budget = BandwidthBudget(args.bwlimit, len(sources), args.parallel)
 
-            print('\033[1A[%d %s] %s %.*s\033[K' % (nfiles, datetime.timedelta(seconds=time.time() - start), ch.updates, cols - 40, filename))
-            sys.stdout.flush()
-        def end_progress():
-            print('\033[1A[%d %s] Done.\033[K' % (nfiles, datetime.timedelta(seconds=time.time() - start)))
-    else:
-        def init_progress():
-            pass
-        def print_progress(path, tree, ch):
-            log.debug('%s', ch)
-        def end_progress():
-            pass
-
-    for pt in args.local:
-        pt = pt.split('=', 1)
-        if len(pt) == 1:
-            (path, tree) = pt[0], os.path.basename(pt[0])
+    # Each tree is finalized on its own, but the first failure is
+    # reported once all transfers are done.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel) as pool:
+        if args.download:
+            futures = [pool.submit(download, args, start, path, tree, progress, budget) for path, tree in sources]
         else:
-            (path, tree) = pt
+            futures = [pool.submit(upload, args, ts, start, path, tree, progress, budget) for path, tree in sources]
 
-        path = os.path.abspath(path)
-        host_base = '/'.join([args.archive.rstrip('/'), 'upload', tree, args.hostname])
+    if args.metrics_file:
+        metrics = {'hostname': args.hostname, 'archive': args.archive, 'snapshot': ts, 'start': start, 'trees': {}}
+        for (path, tree), future in zip(sources, futures):
+            if future.exception():
+                m = {'status': 'failed'}
+            elif future.result() is None:
+                m = {'status': 'skipped'}
+            else:
+                m = dict(future.result().as_dict(), status='ok')
+            metrics['trees'][tree] = m
+        write_metrics(args.metrics_file, metrics)
 
-        log.debug('Starting upload for tree %r...', tree)
-        while True:
-            init_progress()
-            try:
-                it = rsync.run_iter(
-                    '/'.join([host_base, ts, '']),
-                    path + os.sep,
-                    archive=True,
-                    bwlimit=args.bwlimit,
-                    compress=True,
-                    dry_run=args.dry_run,
-                    fake_super=True,
-                    filter=args.filter,
-                    ignore_existing=True,
-                    link_dest=remote_path('/'.join([host_base, 'latest', ''])),
-                    max_size=args.max_file_size,
-                    prune_empty_dirs=True,
-                    safe_links=True,
-                    temp_dir=remote_path('/'.join([host_base, 'tmp', ''])),
-                    timeout=args.timeout,
-                    gen_changes=rsync.FileChange(filename=True, size=True, updates=True, mtime=True))
-                next_progress = time.time()
-                for ch in it:
-                    nfiles += 1
-                    t = time.time()
-                    if next_progress <= t:
-                        print_progress(path, tree, ch)
-                        while next_progress <= t:
-                            next_progress += 1
-                break
-            except subprocess.CalledProcessError as ex:
-                now = time.time()
-                if now - start >= args.timeout:
-                    raise
-            finally:
-                end_progress()
-
-            log.warning('Upload failed. Retrying in 5 s...')
-            time.sleep(5)
-
-        log.info('Finalizing upload of tree %r after %d files...', tree, nfiles)
-        with tempfile.TemporaryDirectory(prefix='rsyba_tmp') as dpath:
-            # TODO: latest-up is annoyingly concurrency unsafe. Add lock or don't overwrite a later one.
-            os.symlink(ts, os.path.join(dpath, 'latest'))
-            os.symlink(ts, os.path.join(dpath, ts + '.complete'))
-            rsync.run(
-                '/'.join([host_base, '']),
-                os.path.join(dpath, 'latest'),
-                os.path.join(dpath, ts + '.complete'),
-                dry_run=args.dry_run,
-                links=True,
-                safe_links=True,
-                temp_dir=remote_path('/'.join([host_base, 'tmp', ''])),
-                timeout=60)
+    for future in futures:
+        future.result()
 
     log.info('All done after %s.', datetime.timedelta(seconds=time.time() - start))
 
@@ -1,8 +1,11 @@
+import collections
 import datetime
+import functools
 import logging
 import os
 import subprocess
 import sys
+import time
 
 log = logging.getLogger(__name__)
 
@@ -27,10 +30,43 @@ EXIT_MAX_DELETE = 25
 EXIT_IO_TIMEOUT = 30
 EXIT_CONN_TIMEOUT = 35
 
+# Exit codes of transient failures, where retrying may succeed.
+RETRYABLE_EXITS = frozenset([
+    EXIT_SOCKET,
+    EXIT_DATA,
+    EXIT_IPC,
+    EXIT_WAIT,
+    EXIT_IO_TIMEOUT,
+    EXIT_CONN_TIMEOUT,
+])
+
+# Exit codes that are mostly persistent, like unreadable source files, but
+# sometimes transient. Worth only a few retries.
+RARELY_RETRYABLE_EXITS = frozenset([
+    EXIT_PARTIAL,
+])
+
+# Exit codes where the transfer completed, except for files that
+# disappeared while it ran.
+COMPLETE_EXITS = frozenset([
+    EXIT_VANISHED,
+])
+
+@functools.lru_cache(maxsize=1024)
 def parse_ts(s):
+    # Fast path for the fixed format, since strptime() is slow. Consecutive
+    # lines often share timestamps, hence the cache.
+    if len(s) == 19 and s[4] == s[7] == '/' and s[10] == '-' and s[13] == s[16] == ':':
+        try:
+            return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+        except ValueError:
+            pass
+
     return datetime.datetime.strptime(s, '%Y/%m/%d-%H:%M:%S')
 
 class FileUpdates(object):
+    __slots__ = ['s']
+
     def __init__(self, s):
         self.s = s
 
@@ -62,7 +98,7 @@ class FileUpdates(object):
     def xattr(self): return self.s[10].replace('x', '-')
 
 class FileChange(object):
-    __fields = [
+    __slots__ = __fields = [
         'transferred',
         'posix_perms',
         'filename',
@@ -85,9 +121,140 @@ class FileChange(object):
                       for f in self.__fields
                       if getattr(self, f) is not None))
 
+class TransferStats(object):
+    """Aggregate statistics of one or more rsync runs.
+
+       Changes are counted as they are generated. The totals printed by
+       --stats (literal and matched data etc.) are only known at the end.
+       The timeline holds [bytes, files] transferred per interval seconds
+       since start.
+    """
+
+    # --stats line label: key
+    TOTALS = {
+        b'Number of files': 'files_total',
+        b'Number of regular files transferred': 'files_transferred',
+        b'Total file size': 'file_size',
+        b'Total transferred file size': 'transferred_file_size',
+        b'Literal data': 'literal_bytes',
+        b'Matched data': 'matched_bytes',
+        b'Total bytes sent': 'sent_bytes',
+        b'Total bytes received': 'received_bytes',
+    }
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.start = time.time()
+        self.end = None
+        self.files = 0
+        self.transferred = 0
+        self.update_types = collections.Counter() # {update_type: count}
+        self.totals = collections.Counter() # {key: int}
+        self.timeline = [] # [[bytes, files]]
+
+    def add(self, ch):
+        t = time.time()
+        self.end = t
+        self.files += 1
+        i = int((t - self.start) // self.interval)
+        while len(self.timeline) <= i:
+            self.timeline.append([0, 0])
+        self.timeline[i][1] += 1
+        if ch.transferred is not None:
+            self.transferred += ch.transferred
+            self.timeline[i][0] += ch.transferred
+        if ch.updates is not None:
+            self.update_types[ch.updates.update_type] += 1
+
+    def parse_line(self, line):
+        """Parse a line of --stats output, returning whether it was one."""
+        label, sep, value = line.partition(b': ')
+        key = self.TOTALS.get(label)
+        if key is None:
+            return False
+
+        # "1,234 bytes" or "3 (reg: 2, dir: 1)"
+        self.totals[key] += int(value.split(None, 1)[0].replace(b',', b''))
+        return True
+
+    def finish(self):
+        self.end = time.time()
+
+    def merge(self, other):
+        """Add the statistics of another (concurrent) transfer to this one."""
+        self.start = min(self.start, other.start)
+        self.end = max(self.end or self.start, other.end or other.start)
+        self.files += other.files
+        self.transferred += other.transferred
+        self.update_types.update(other.update_types)
+        self.totals.update(other.totals)
+        offset = int((other.start - self.start) // self.interval)
+        for i, (nbytes, nfiles) in enumerate(other.timeline, offset):
+            while len(self.timeline) <= i:
+                self.timeline.append([0, 0])
+            self.timeline[i][0] += nbytes
+            self.timeline[i][1] += nfiles
+
+    def as_dict(self):
+        return {
+            'start': self.start,
+            'duration': (self.end or self.start) - self.start,
+            'files': self.files,
+            'transferred_bytes': self.transferred,
+            'update_types': dict(self.update_types),
+            'totals': dict(self.totals),
+            'interval': self.interval,
+            'timeline': self.timeline,
+        }
+
 RSYNC = os.environ.get('RSYBA_RSYNC', 'rsync')
 CHANGE_PREFIX = '$change'
 
+class ChangeParser(object):
+    """Parses rsync --out-format lines into FileChange objects.
+
+       The format and per-field parsers are fixed when the parser is
+       created, once per run_iter() call.
+    """
+
+    # (format, field, parser), in output order. None parsers keep strings.
+    FIELDS = [
+        ('%b', 'transferred', int),
+        ('%B', 'posix_perms', None),
+        ('%i', 'updates', FileUpdates),
+        ('%l', 'size', int),
+        ('%M', 'mtime', parse_ts),
+        ('%o', 'op', None),
+        ('%t', 'time', parse_ts),
+        ('%U', 'uid', int),
+        ('%G', 'gid', int),
+        # Always last, since file names may contain tabs:
+        ('%f', 'filename', None),
+    ]
+
+    def __init__(self, gen_changes):
+        fields = [f for f in self.FIELDS if gen_changes is True or getattr(gen_changes, f[1])]
+        self.out_format = '\t'.join([CHANGE_PREFIX] + [fmt for fmt, _, _ in fields])
+        self.prefix = (CHANGE_PREFIX + '\t').encode('utf-8')
+        self.nsplit = len(fields) - 1
+        # Slot descriptors are the fastest way to fill in a FileChange.
+        self.setters = [(getattr(FileChange, field).__set__, func) for _, field, func in fields]
+        self.unset = [getattr(FileChange, f[1]).__set__ for f in self.FIELDS if f not in fields]
+
+    def parse(self, line):
+        """Parse a line of bytes, returning None if it is not a change line."""
+        if not line.startswith(self.prefix):
+            return None
+
+        parts = line[len(self.prefix):].rstrip(b'\n').decode('utf-8').split('\t', self.nsplit)
+        ch = FileChange.__new__(FileChange)
+        for (set, func), s in zip(self.setters, parts):
+            set(ch, s if func is None else func(s))
+        for set in self.unset:
+            set(ch, None)
+
+        return ch
+
 def run(*args, gen_changes=None, **kwargs):
     if gen_changes is not None:
         raise TypeError('gen_changes not supported with run(); use run_iter()')
@@ -95,51 +262,50 @@ def run(*args, gen_changes=None, **kwargs):
     for _ in run_iter(*args, **kwargs):
         pass
 
-def run_iter(dest, *srcs, rsync_bin=RSYNC, gen_changes=None, **kwargs):
+def run_iter(dest, *srcs, rsync_bin=RSYNC, gen_changes=None, transfer_stats=None, **kwargs):
+    """Run rsync, yielding FileChange objects if gen_changes is given.
+
+       If transfer_stats is a TransferStats, changes and --stats totals are
+       added to it as they are seen.
+    """
     kwargs.setdefault('motd', False)
     #kwargs.setdefault('rsync_path', 'rsyba-server --')
 
-    out_format = []
-    out_fields = []
-    def add_out(fmt, field, parser=lambda x: x):
-        if gen_changes is True or getattr(gen_changes, field):
-            out_format.append(fmt)
-            out_fields.append((field, parser))
-
     if gen_changes:
-        out_format.append(CHANGE_PREFIX)
-        add_out('%b', 'transferred', int)
-        add_out('%B', 'posix_perms')
-        add_out('%i', 'updates', FileUpdates)
-        add_out('%l', 'size', int)
-        add_out('%M', 'mtime', parse_ts)
-        add_out('%o', 'op')
-        add_out('%t', 'time', parse_ts)
-        add_out('%U', 'uid', int)
-        add_out('%G', 'gid', int)
-        # Always last:
-        add_out('%f', 'filename')
-
-        kwargs['out_format'] = '\t'.join(out_format)
-    else:
+        parser = ChangeParser(gen_changes)
+        kwargs['out_format'] = parser.out_format
+    elif transfer_stats is None:
         kwargs.setdefault('quiet', True)
+    if transfer_stats is not None:
+        kwargs['stats'] = True
+    read_output = gen_changes or transfer_stats is not None
 
     opts = []
     for optl in [_option(k, v) for (k, v) in sorted(kwargs.items())]:
         opts.extend(optl)
 
     cmd = [rsync_bin] + opts + list(srcs) + [dest]
-    p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE if gen_changes else None)
+    p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE if read_output else None)
 
     try:
-        if gen_changes:
+        if transfer_stats is not None:
+            parse = parser.parse if gen_changes else lambda line: None
             for item in p.stdout:
-                item = str(item, 'utf-8')
-                if not item.startswith(CHANGE_PREFIX + '\t'):
-                    continue
+                ch = parse(item)
+                if ch is not None:
+                    transfer_stats.add(ch)
+                    yield ch
+                else:
+                    transfer_stats.parse_line(item)
 
-                parts = item.rstrip().split('\t', len(out_fields) - 1 + 1)[1:]
-                yield FileChange(**{field: func(s) for s, (field, func) in zip(parts, out_fields)})
+            p.stdout.close()
+            transfer_stats.finish()
+        elif gen_changes:
+            parse = parser.parse
+            for item in p.stdout:
+                ch = parse(item)
+                if ch is not None:
+                    yield ch
 
             p.stdout.close()
         else:
@@ -33,12 +33,113 @@ test_two_trees() {
     python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a" "$d/local/host1/b"
 }
 
+test_parallel_trees() {
+    python3 -m rsyba.client --hostname=host1 --parallel=2 --bwlimit=1000 "$d/archive" "$d/local/host1/a" "$d/local/host1/b"
+}
+
+test_metrics_file() {
+    python3 -m rsyba.client --hostname=host1 --metrics-file="$d/metrics.json" "$d/archive" "$d/local/host1/a" "$d/local/host1/b"
+    python3 -c 'import json, sys; m = json.load(open(sys.argv[1])); assert sorted(m["trees"]) == ["a", "b"], m' "$d/metrics.json"
+    python3 -m rsyba.client --hostname=host1 --metrics-file="$d/metrics.prom" "$d/archive" "$d/local/host1/a"
+    grep -q '^rsyba_upload_status{host="host1",status="ok",tree="a"} 1$' "$d/metrics.prom"
+}
+
+test_sharded_tree() {
+    mkdir -p "$d/local/host1/c"/{x,y,z}
+    echo cX >"$d/local/host1/c/x/X"
+    echo cY >"$d/local/host1/c/y/Y"
+    echo cZ >"$d/local/host1/c/z/Z"
+    echo cW >"$d/local/host1/c/W"
+    python3 -m rsyba.server --archive="$d/archive" add-sources --tree=c
+    python3 -m rsyba.client --hostname=host1 --shards=3 "$d/archive" "$d/local/host1/c"
+}
+
+test_skip_unchanged() {
+    python3 -m rsyba.client --hostname=host1 --skip-unchanged --state-dir="$d/state" "$d/archive" "$d/local/host1/a" "$d/local/host1/b"
+    latest="$(readlink "$d/archive/upload/a/host1/latest")"
+    sleep 0.01
+    echo bF >"$d/local/host1/b/F"
+    python3 -m rsyba.client --hostname=host1 --skip-unchanged --state-dir="$d/state" "$d/archive" "$d/local/host1/a" "$d/local/host1/b"
+    [ "$(readlink "$d/archive/upload/a/host1/latest")" = "$latest" ]
+    [ "$(readlink "$d/archive/upload/b/host1/latest")" != "$latest" ]
+}
+
 test_two_snapshots() {
     python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
     sleep 0.01
     python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
 }
 
+test_build_manifests() {
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.server --archive="$d/archive" build-manifests --all
+    [ -e "$d/archive/upload/a/host1/$(readlink "$d/archive/upload/a/host1/latest").manifest" ]
+    python3 -m rsyba.server --archive="$d/archive" dedup-snapshots --tree=a --host=host1 --host=host2
+}
+
+test_rsync_server() {
+    python3 -m rsyba.server --archive="$d/archive" rsync-server --max-transfers=1 --max-tree-transfers=1 -- --archive "$d/local/host2/a/" "$d/archive/upload/a/host3/x/"
+    [ -d "$d/archive/upload/a/host3/tmp" ]
+    [ -e "$d/archive/upload/a/host3/x/D" ]
+}
+
+test_diff_snapshots() {
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    old="$(readlink "$d/archive/upload/a/host1/latest")"
+    sleep 0.01
+    echo aD >"$d/local/host1/a/D"
+    rm "$d/local/host1/a/C"
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    [ "$(python3 -m rsyba.server --archive="$d/archive" diff-snapshots --tree=a --host=host1 "$old")" = "$(printf -- '- C\n+ D')" ]
+    python3 -m rsyba.server --archive="$d/archive" diff-snapshots --tree=a --host=host1 --json --checksum "$old"
+}
+
+test_merge_files() {
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    python3 -m rsyba.server --archive="$d/archive" merge-files --tree=a
+    [ "$(cat "$d/archive/download/a/host1/latest/D")" = aD ]
+    [ "$(cat "$d/archive/download/a/host2/latest/B")" = aB ]
+    python3 -m rsyba.server --archive="$d/archive" merge-files --tree=a --strategy=host-suffix
+}
+
+test_merge_files_conflicts() {
+    echo aX >"$d/local/host1/a/X"
+    mkdir "$d/local/host2/a/X"
+    echo aXY >"$d/local/host2/a/X/Y"
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    rm "$d/archive/download/a/host2/latest"
+    python3 -m rsyba.server --archive="$d/archive" merge-files --tree=a
+    # Each host keeps its own version, and gets the other one renamed.
+    [ "$(cat "$d/archive/download/a/host1/latest/X")" = aX ]
+    [ "$(cat "$d/archive/download/a/host1/latest/X~host2/Y")" = aXY ]
+    [ "$(cat "$d/archive/download/a/host2/latest/X/Y")" = aXY ]
+    [ "$(cat "$d/archive/download/a/host2/latest/X~host1")" = aX ]
+}
+
+test_merge_files_stale_latest() {
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    # As left by a merge killed before renaming it.
+    ln -s stale "$d/archive/download/a/host1/latest.tmp"
+    python3 -m rsyba.server --archive="$d/archive" merge-files --tree=a
+    [ -e "$d/archive/download/a/host1/latest/D" ]
+}
+
+test_download() {
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    python3 -m rsyba.server --archive="$d/archive" merge-files --tree=a
+    sleep 0.01
+    echo aB2 >"$d/local/host1/a/B"
+    python3 -m rsyba.client --download --hostname=host1 --metrics-file="$d/metrics.json" "$d/archive" "$d/local/host1/a"
+    [ "$(cat "$d/local/host1/a/D")" = aD ]
+    [ "$(cat "$d/local/host1/a/B")" = aB2 ]
+    # Only host2's files were sent.
+    python3 -c 'import json, sys; m = json.load(open(sys.argv[1])); assert m["trees"]["a"]["files"] == 2, m' "$d/metrics.json"
+}
+
 test_prune_snapshots() {
     python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
     sleep 0.01
@@ -51,12 +152,142 @@ test_prune_snapshots() {
     python3 -m rsyba.server --archive="$d/archive" prune-snapshots --host=host1 --tree=a
 }
 
+test_prune_snapshots_relative() {
+    for i in 1 2 3 4; do
+        printf "%${i}s" >"$d/local/host1/a/N"
+        python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+        sleep 0.01
+    done
+    sleep 1
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    oldest="$(ls "$d/archive/upload/a/host1" | grep '[0-9]$' | head -n1)"
+    ln -sfn "../../../upload/a/host1/$oldest" "$d/archive/download/a/host1/latest"
+    # The default --archive is the current directory.
+    (export PYTHONPATH="$PWD"; cd "$d/archive" && python3 -m rsyba.server prune-snapshots --all)
+    [ -e "$d/archive/download/a/host1/latest/" ]
+}
+
+test_prune_snapshots_all() {
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a" "$d/local/host1/b"
+    sleep 0.01
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a" "$d/local/host1/b"
+    sleep 0.01
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    sleep 0.01
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a" "$d/local/host1/b"
+
+    python3 -m rsyba.server --archive="$d/archive" prune-snapshots --all --jobs=2
+}
+
+test_space_report() {
+    # Until host2 uploads, its latest protects all of host1's snapshots.
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    # Old snapshots close together share a garbage bucket, and each has
+    # its own version of N.
+    for i in 1 2 3 4; do
+        printf "%${i}s" >"$d/local/host1/a/N"
+        python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+        sleep 0.01
+    done
+    sleep 1
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    # Likewise the initial download latest links.
+    python3 -m rsyba.server --archive="$d/archive" merge-files --tree=a
+    python3 -m rsyba.server --archive="$d/archive" space-report --all
+    freed="$(python3 -m rsyba.server --archive="$d/archive" space-report --json --tree=a | python3 -c 'import json, sys; print(json.load(sys.stdin)["garbage"]["freed_bytes"])')"
+    [ "$freed" -gt 0 ]
+    python3 -m rsyba.server -v --archive="$d/archive" prune-snapshots --all 2>&1 | grep "and $freed bytes freed"
+}
+
+test_catalog() {
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    sleep 0.01
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    # Listings are only saved once they are older than the racy window.
+    sleep 3
+    # Like an archive initialized before index/ existed.
+    rm -r "$d/archive/index"
+    python3 -m rsyba.server --archive="$d/archive" --catalog prune-snapshots --all
+    [ -e "$d/archive/index/catalog.json" ]
+
+    # The new snapshot changes the host directory mtime, so it is seen.
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    diff -u \
+        <(python3 -m rsyba.server --archive="$d/archive" prune-snapshots -n --all) \
+        <(python3 -m rsyba.server --archive="$d/archive" --catalog prune-snapshots -n --all)
+    python3 -m rsyba.server --archive="$d/archive" --catalog prune-snapshots --all
+    [ -e "$d/archive/upload/a/host1/latest/" ]
+}
+
 test_dedup_snapshots() {
     python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
     python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
     python3 -m rsyba.server --archive="$d/archive" dedup-snapshots --host=host1 --host=host2 --tree=a
 }
 
+test_dedup_snapshots_twice() {
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    python3 -m rsyba.server --archive="$d/archive" dedup-snapshots --host=host1 --host=host2 --tree=a
+    python3 -m rsyba.server --archive="$d/archive" dedup-snapshots --host=host1 --host=host2 --tree=a
+}
+
+test_dedup_snapshots_by_content() {
+    cp "$d/local/host2/a/D" "$d/local/host2/a/D2"
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    python3 -m rsyba.server --archive="$d/archive" dedup-snapshots --by-content --host=host1 --host=host2 --tree=a
+}
+
+test_dedup_snapshots_interrupted() {
+    cp "$d/local/host2/a/D" "$d/local/host2/a/D2"
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    python3 -m rsyba.server --archive="$d/archive" build-manifests --all
+    # Stop after the first link, like an interrupt would.
+    ! python3 -c '
+import sys
+from rsyba import server
+def count(name, n=1):
+    if name == "links_replaced":
+        raise KeyboardInterrupt()
+arch = server.FileSystemArchive(sys.argv[1])
+arch.instr.count = count
+arch.dedup_snapshots("a", ["host1", "host2"], by_content=True)
+' "$d/archive" 2>/dev/null
+    python3 -m rsyba.server --archive="$d/archive" dedup-snapshots --by-content --host=host1 --host=host2 --tree=a
+    python3 -m rsyba.server --archive="$d/archive" dedup-snapshots --by-content --host=host1 --host=host2 --tree=a
+    [ -z "$(ls "$d/archive/tmp")" ]
+}
+
+test_dedup_snapshots_incremental() {
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    python3 -m rsyba.server --archive="$d/archive" dedup-snapshots --incremental --host=host1 --host=host2 --tree=a
+    echo aF >"$d/local/host1/a/F"
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.server --archive="$d/archive" dedup-snapshots --incremental --host=host1 --host=host2 --tree=a
+}
+
+test_dedup_snapshots_stale_watermark() {
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    # As left by a run killed before renaming it.
+    ln -s stale "$d/archive/upload/a/host1/deduped.tmp"
+    python3 -m rsyba.server --archive="$d/archive" dedup-snapshots --incremental --host=host1 --host=host2 --tree=a
+    [ "$(readlink "$d/archive/upload/a/host1/deduped")" != stale ]
+}
+
+test_profile() {
+    python3 -m rsyba.client --hostname=host1 "$d/archive" "$d/local/host1/a"
+    python3 -m rsyba.client --hostname=host2 "$d/archive" "$d/local/host2/a"
+    python3 -m rsyba.server -v --archive="$d/archive" --profile="$d/dedup.prof" --report-interval=0.01 \
+        dedup-snapshots --host=host1 --host=host2 --tree=a 2>"$d/dedup.log"
+    grep -q '^dedup.scan ' "$d/dedup.log"
+    grep -q '^Counters: .*files_visited' "$d/dedup.log"
+    python3 -c 'import pstats, sys; pstats.Stats(sys.argv[1])' "$d/dedup.prof"
+}
+
 if [ $# -eq 0 ]; then
     tests=( $(declare -F | sed -e 's:^declare -f :: p ; d' | grep '^test_') )
 else